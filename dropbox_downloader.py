@@ -1,11 +1,21 @@
 import argparse
 import hashlib
+import itertools
+import json
+import mmap
+import os
+import queue
+import threading
+from array import array
+from concurrent.futures import Executor, ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import List
+from typing import List, Optional, Tuple
 
 import dropbox
 import dropbox.files
-import six
+
+# Verified (size, mtime_ns, content_hash) of local files, keyed by file name
+HASH_CACHE_NAME = ".dropbox_hash_cache.json"
 
 
 class DropboxContentHasher:
@@ -51,22 +61,33 @@ class DropboxContentHasher:
             )
 
         assert isinstance(
-            new_data, six.binary_type
+            new_data, (bytes, bytearray, memoryview)
         ), "Expecting a byte string, got {!r}".format(new_data)
 
-        new_data_pos = 0
-        while new_data_pos < len(new_data):
-            if self._block_pos == self.BLOCK_SIZE:
-                self._overall_hasher.update(self._block_hasher.digest())
-                self._block_hasher = hashlib.sha256()
-                self._block_pos = 0
+        new_data = memoryview(new_data).cast("B")  # zero-copy slicing
+
+        # Fast path: the data fits in the current block
+        if self._block_pos + len(new_data) <= self.BLOCK_SIZE:
+            self._block_hasher.update(new_data)
+            self._block_pos += len(new_data)
+            return
+
+        # Work on locals and write the state back once at the end
+        block_size = self.BLOCK_SIZE
+        block_hasher, block_pos = self._block_hasher, self._block_pos
+        new_data_pos, new_data_len = 0, len(new_data)
+        while new_data_pos < new_data_len:
+            if block_pos == block_size:
+                self._overall_hasher.update(block_hasher.digest())
+                block_hasher = hashlib.sha256()
+                block_pos = 0
 
-            space_in_block = self.BLOCK_SIZE - self._block_pos
-            part = new_data[new_data_pos : (new_data_pos + space_in_block)]
-            self._block_hasher.update(part)
+            part = new_data[new_data_pos : new_data_pos + block_size - block_pos]
+            block_hasher.update(part)
 
-            self._block_pos += len(part)
+            block_pos += len(part)
             new_data_pos += len(part)
+        self._block_hasher, self._block_pos = block_hasher, block_pos
 
     def _finish(self):
         if self._overall_hasher is None:
@@ -95,7 +116,7 @@ class DropboxContentHasher:
         return c
 
 
-def authorize_dropbox(app_key: str, app_secret: str):
+def authorize_dropbox(app_key: str, app_secret: str, max_connections: int = 8):
     print("\n==== Authorizing Dropbox ====")
     flow = dropbox.DropboxOAuth2FlowNoRedirect(
         app_key, app_secret, token_access_type="offline"
@@ -113,101 +134,298 @@ def authorize_dropbox(app_key: str, app_secret: str):
         oauth2_access_token_expiration=auth_res.expires_at,
         app_key=args.app_key,
         app_secret=args.app_secret,
+        # The SDK pools 8 connections by default; size the pool to the download
+        # workers so each one keeps its own keep-alive connection
+        session=dropbox.create_session(max_connections=max(1, max_connections)),
     )
     return dbx
 
 
-def check_file_hash(file_path: Path, expected_hash: str):
-    hasher = DropboxContentHasher()
+def _advise_sequential(fd: int):
+    # Let the kernel read ahead while we hash; not available on macOS/Windows.
+    # Only the first blocks are prefetched eagerly, so large files don't flood
+    # the page cache; sequential readahead covers the rest.
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        os.posix_fadvise(
+            fd, 0, 2 * DropboxContentHasher.BLOCK_SIZE, os.POSIX_FADV_WILLNEED
+        )
+
+
+def _sha256_blocks(views, executor: Optional[Executor] = None) -> List[bytes]:
+    # hashlib releases the GIL on large buffers, so blocks hash in parallel
+    if len(views) < 2:
+        return [hashlib.sha256(view).digest() for view in views]
+    if executor is not None:
+        return list(executor.map(lambda view: hashlib.sha256(view).digest(), views))
+    with ThreadPoolExecutor(max_workers=min(len(views), os.cpu_count() or 1)) as ex:
+        return _sha256_blocks(views, ex)
+
+
+def dropbox_content_hexdigest(file_path: Path, executor: Optional[Executor] = None):
+    block_size = DropboxContentHasher.BLOCK_SIZE
+    overall_hasher = hashlib.sha256()
     with open(file_path, "rb") as f:
-        while True:
-            chunk = f.read(hasher.BLOCK_SIZE)
-            if len(chunk) == 0:
-                break
-            hasher.update(chunk)
-    return hasher.hexdigest() == expected_hash
+        file_size = os.fstat(f.fileno()).st_size
+        if 0 < file_size <= block_size:
+            # Single block: one read and one hashlib call, no per-file setup
+            overall_hasher.update(hashlib.sha256(f.read()).digest())
+        elif file_size > block_size:
+            _advise_sequential(f.fileno())
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if hasattr(mmap, "MADV_SEQUENTIAL"):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                with memoryview(mm) as mv:
+                    views = [
+                        mv[pos : pos + block_size]
+                        for pos in range(0, file_size, block_size)
+                    ]
+                    overall_hasher.update(b"".join(_sha256_blocks(views, executor)))
+                    for view in views:
+                        view.release()
+    return overall_hasher.hexdigest()
+
+
+def check_file_hash(
+    file_path: Path, expected_hash: str, executor: Optional[Executor] = None
+):
+    return dropbox_content_hexdigest(file_path, executor) == expected_hash
+
 
+def _pin_to_core(cores: List[int], counter):
+    # Keep each hashing thread on one core for cache locality (Linux only)
+    os.sched_setaffinity(0, {cores[next(counter) % len(cores)]})
 
-def fetch_entries(dbx: dropbox.Dropbox, link: str, save_dir: Path):
+
+def hashing_thread_pool():
+    if not hasattr(os, "sched_setaffinity"):
+        return ThreadPoolExecutor(max_workers=os.cpu_count())
+    cores = sorted(os.sched_getaffinity(0))
+    return ThreadPoolExecutor(
+        max_workers=len(cores),
+        initializer=_pin_to_core,
+        initargs=(cores, itertools.count()),
+    )
+
+
+def load_hash_cache(save_dir: Path):
+    try:
+        with open(save_dir / HASH_CACHE_NAME) as f:
+            return {name: tuple(value) for name, value in json.load(f).items()}
+    except (FileNotFoundError, ValueError, AttributeError, TypeError):
+        # Missing, or not a JSON object of lists: start from an empty cache
+        return {}
+
+
+def save_hash_cache(save_dir: Path, hash_cache: dict):
+    cache_path = save_dir / HASH_CACHE_NAME
+    tmp_path = cache_path.with_name(cache_path.name + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(hash_cache, f)
+    os.replace(tmp_path, cache_path)
+
+
+def fetch_entries(
+    dbx: dropbox.Dropbox, link: str, save_dir: Path
+) -> Tuple[List[str], array, List[str]]:
     print("\n==== Fetching entries to download ====")
     link = dropbox.files.SharedLink(url=link)
-    entries_to_download, total_size, total_num = [], 0, 0
-    res = dbx.files_list_folder(path="", shared_link=link)
-    while True:
-        entries = res.entries
-        total_num += len(entries)
-        for entry in entries:
-            if isinstance(entry, dropbox.files.FileMetadata):
-                save_path = save_dir / entry.name
-                if save_path.exists() and save_path.stat().st_size == entry.size:
-                    if check_file_hash(save_path, entry.content_hash):
-                        print(f"Skipping: {entry.name} (already downloaded)", end="\r")
+    # Parallel arrays, so downloads never touch the SDK metadata objects
+    names, sizes, hashes = [], array("q"), []
+    total_num = 0
+    hash_cache = load_hash_cache(save_dir)
+    # Bound once so the per-entry checks avoid module attribute lookups
+    FileMetadata = dropbox.files.FileMetadata
+    FolderMetadata = dropbox.files.FolderMetadata
+    res = dbx.files_list_folder(path="", shared_link=link, limit=2000)
+    with hashing_thread_pool() as ex, ThreadPoolExecutor(max_workers=1) as lister:
+        while True:
+            # Fetch the next page while this one is being verified
+            next_res = None
+            if res.has_more:
+                next_res = lister.submit(dbx.files_list_folder_continue, res.cursor)
+
+            entries = res.entries
+            total_num += len(entries)
+            candidates = []
+            for entry in entries:
+                entry_type = type(entry)
+                if entry_type is FileMetadata:
+                    save_path = save_dir / entry.name
+                    try:
+                        st = os.stat(save_path)
+                    except FileNotFoundError:
+                        st = None
+                    if st is not None and st.st_size == entry.size:
+                        file_key = (st.st_size, st.st_mtime_ns, entry.content_hash)
+                        if hash_cache.get(entry.name) == file_key:
+                            # Unchanged since it was last verified
+                            print(
+                                f"Skipping: {entry.name} (already downloaded)", end="\r"
+                            )
+                            continue
+                        candidates.append((entry, file_key))
                         continue
-                total_size += entry.size
-                entries_to_download.append(entry)
-            elif isinstance(entry, dropbox.files.FolderMetadata):
-                # TODO: Support recursive download
-                raise NotImplementedError("Recursive download is not supported yet")
-            else:
-                raise ValueError(f"Unknown entry type: {type(entry)}")
+                    names.append(entry.name)
+                    sizes.append(entry.size)
+                    hashes.append(entry.content_hash)
+                elif entry_type is FolderMetadata:
+                    # TODO: Support recursive download
+                    raise NotImplementedError("Recursive download is not supported yet")
+                else:
+                    raise ValueError(f"Unknown entry type: {entry_type}")
+
+            # Small files are a single hashlib call each (which releases the
+            # GIL), so batch them over the pinned worker threads. Large files
+            # are checked one at a time with their blocks on the same workers.
+            block_size = DropboxContentHasher.BLOCK_SIZE
+            small = [c for c in candidates if c[0].size <= block_size]
+            large = [c for c in candidates if c[0].size > block_size]
+            futures = [
+                ex.submit(check_file_hash, save_dir / entry.name, entry.content_hash)
+                for entry, _ in small
+            ]
+            matches = [
+                check_file_hash(save_dir / entry.name, entry.content_hash, ex)
+                for entry, _ in large
+            ]
+            matches = [future.result() for future in futures] + matches
+            for (entry, file_key), matched in zip(small + large, matches):
+                if matched:
+                    hash_cache[entry.name] = file_key
+                    print(f"Skipping: {entry.name} (already downloaded)", end="\r")
+                    continue
+                names.append(entry.name)
+                sizes.append(entry.size)
+                hashes.append(entry.content_hash)
+            # Once per page rather than per entry to keep terminal writes cheap
             print(
-                f"Found {len(entries_to_download)}/{total_num} files to download",
+                f"Found {len(names)}/{total_num} files to download",
                 end="\r",
             )
 
-        if not res.has_more:
+            if next_res is None:
+                break
+            res = next_res.result()
+
+    save_hash_cache(save_dir, hash_cache)
+    print(f"Found {len(names)}/{total_num} files ({sum(sizes)} bytes) to download")
+    return names, sizes, hashes
+
+
+def _hash_chunks(chunks: queue.Queue, hasher: DropboxContentHasher, errors: list):
+    # Keep draining after a failure so the writer never blocks on a full queue
+    while True:
+        chunk = chunks.get()
+        if chunk is None:
             break
-        res = dbx.files_list_folder_continue(res.cursor)
+        if errors:
+            continue
+        try:
+            hasher.update(chunk)
+        except BaseException as e:
+            errors.append(e)
 
-    print(
-        f"Found {len(entries_to_download)}/{total_num} files ({total_size} bytes) to download"
-    )
-    return entries_to_download
+
+def download_entry(
+    dbx: dropbox.Dropbox,
+    name: str,
+    content_hash: str,
+    link: str,
+    save_dir: Path,
+    retry: int = 5,
+):
+    save_path = save_dir / name
+    for retry_i in range(retry):
+        try:
+            # Hash while writing so the file never has to be read back. The body
+            # arrives over TLS and is decrypted in userspace, so an in-kernel
+            # splice()/sendfile() from the socket is not an option here.
+            _, res = dbx.sharing_get_shared_link_file(link, f"/{name}")
+            # Hashing runs on its own thread so the next chunk is received and
+            # written while the previous one is hashed
+            hasher = DropboxContentHasher()
+            chunks = queue.Queue(maxsize=4)
+            hash_errors = []
+            hash_thread = threading.Thread(
+                target=_hash_chunks, args=(chunks, hasher, hash_errors)
+            )
+            hash_thread.start()
+            try:
+                with res, open(save_path, "wb") as f:
+                    for chunk in res.iter_content(chunk_size=1024 * 1024):
+                        f.write(chunk)
+                        chunks.put(chunk)
+            finally:
+                chunks.put(None)
+                hash_thread.join()
+            if hash_errors:
+                save_path.unlink()
+                raise hash_errors[0]
+            if hasher.hexdigest() != content_hash:
+                save_path.unlink()
+                raise ValueError(f"Downloaded {name} hash does not match")
+            return True
+        except Exception as e:
+            if retry_i < retry - 1:
+                if dbx.check_and_refresh_access_token():
+                    print("Access token refreshed. Retrying...", end="\r")
+                else:
+                    print(
+                        f"Failed to download {name}: {e}. Retrying...",
+                        end="\r",
+                    )
+            else:
+                print(f"Failed to download {name}: {e}. Skipping...")
+    return False
 
 
 def download_entries(
     dbx: dropbox.Dropbox,
-    entries: List[dropbox.files.FileMetadata],
+    entries: Tuple[List[str], array, List[str]],
     link: str,
     save_dir: Path,
     retry: int = 5,
+    num_workers: int = 8,
 ):
     print("\n==== Downloading entries ====")
-    for idx, entry in enumerate(entries):
-        save_path = save_dir / entry.name
-        for retry_i in range(retry):
-            try:
-                print(f"Downloading {idx + 1}/{len(entries)}: {entry.name}", end="\r")
-                dbx.sharing_get_shared_link_file_to_file(
-                    save_path, link, f"/{entry.name}"
-                )
-                if not check_file_hash(save_path, entry.content_hash):
-                    save_path.unlink()
-                    raise ValueError("Downloaded {entry.name} hash does not match")
-                break
-            except Exception as e:
-                if retry_i < retry - 1:
-                    if dbx.check_and_refresh_access_token():
-                        print("Access token refreshed. Retrying...", end="\r")
-                    else:
-                        print(
-                            f"Failed to download {entry.name}: {e}. Retrying...",
-                            end="\r",
-                        )
+    names, _, hashes = entries
+    hash_cache = load_hash_cache(save_dir)
+    # Downloads are network-bound, so a few in flight at once hide latency
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as ex:
+        futures = {
+            ex.submit(download_entry, dbx, name, hashes[i], link, save_dir, retry): i
+            for i, name in enumerate(names)
+        }
+        try:
+            for idx, future in enumerate(as_completed(futures)):
+                i = futures[future]
+                name, content_hash = names[i], hashes[i]
+                if future.result():
+                    st = os.stat(save_dir / name)
+                    hash_cache[name] = (st.st_size, st.st_mtime_ns, content_hash)
+                    print(f"Downloaded {idx + 1}/{len(names)}: {name}", end="\r")
                 else:
-                    print(f"Failed to download {entry.name}: {e}. Skipping...")
+                    print(f"Failed {idx + 1}/{len(names)}: {name}", end="\r")
+        except BaseException:
+            # Don't wait for the queued downloads on Ctrl-C or errors
+            ex.shutdown(wait=False, cancel_futures=True)
+            raise
+        finally:
+            # Keep the files verified so far even if the run is interrupted
+            save_hash_cache(save_dir, hash_cache)
     print("Download completed")
 
 
 def main(args):
-    dbx = authorize_dropbox(args.app_key, args.app_secret)
+    dbx = authorize_dropbox(args.app_key, args.app_secret, args.num_workers)
 
     save_dir = Path(args.save_dir).absolute()
     print("\nSave directory:", save_dir)
     save_dir.mkdir(exist_ok=True, parents=True)
 
     entries = fetch_entries(dbx, args.link, save_dir)
-    download_entries(dbx, entries, args.link, save_dir, args.retry)
+    download_entries(dbx, entries, args.link, save_dir, args.retry, args.num_workers)
 
     dbx.close()
 
@@ -227,6 +445,9 @@ if __name__ == "__main__":
     parser.add_argument(
         "--retry", type=int, default=5, help="Number of retries for download"
     )
+    parser.add_argument(
+        "--num-workers", type=int, default=8, help="Number of parallel downloads"
+    )
     parser.add_argument(
         "--link", required=True, help="Shared folder link to download from Dropbox"
     )